@@ -9,8 +9,11 @@ import select
 import socket
 import errno
 import time
-import bisect
+import threading
+import heapq
 import logging
+import random
+from collections import deque
 
 try:
     import ssl
@@ -19,6 +22,16 @@ except ImportError:
     import dummyssl as ssl
     HAS_SSL = False
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None  # handshakes will run in the loop
+
+try:
+    from os import cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
+
 from snakemq.exceptions import SendNotFinished
 
 from snakemq.poll import poll
@@ -29,14 +42,76 @@ from snakemq.callbacks import Callback
 ############################################################################
 
 RECONNECT_INTERVAL = 3.0
-RECV_BLOCK_SIZE = 256 * 1024
+RECONNECT_MAX_INTERVAL = 60.0
+RECV_BLOCK_SIZE = 64 * 1024
 POLL_TIMEOUT = 0.2
-BELL_READ = 1024
+MAX_POLL_EVENTS = 1024  #: max events returned by one poll call
+MAX_RECV_DRAIN = 4  #: max recv calls per one readiness event
+MAX_ACCEPT_DRAIN = 16  #: max accepts per one readiness event
+MAX_STALE_PLANS = 64  #: cancelled plans left in the heap before compaction
+MAX_HANDSHAKES = 1024
+MAX_WRITE_BUF = 4 * 1024 * 1024
+
+#: sockets are polled in edge-triggered mode, the poller is touched only
+#: if the mask changes; peer's shutdown is reported so that a short read
+#: does not leave a pending EOF behind
+POLL_EDGE = select.EPOLLET | select.EPOLLRDHUP
+POLL_ERR = select.EPOLLERR | select.EPOLLHUP
 
 SSL_HANDSHAKE_IN_PROGRESS = 0
 SSL_HANDSHAKE_DONE = 1
 SSL_HANDSHAKE_FAILED = 2
 
+RECV_BUF_POOL_SIZE = 32
+
+############################################################################
+############################################################################
+
+#: free receive buffers shared by all links, see :func:`_acquire_recv_buf`
+_RECV_BUF_POOL = deque(maxlen=RECV_BUF_POOL_SIZE)
+
+def _acquire_recv_buf(size):
+    """
+    Borrow a receive buffer of at least ``size`` bytes. Return it with
+    :func:`_release_recv_buf` after the received data were consumed.
+    """
+    if size > RECV_BLOCK_SIZE:
+        return bytearray(size)
+    try:
+        return _RECV_BUF_POOL.pop()
+    except IndexError:
+        return bytearray(RECV_BLOCK_SIZE)
+
+def _release_recv_buf(buf):
+    # oversized buffers are dropped to keep the pool memory bounded
+    if len(buf) == RECV_BLOCK_SIZE:
+        _RECV_BUF_POOL.append(buf)
+
+############################################################################
+############################################################################
+
+def _do_handshake(ssl_sock):
+    """
+    One non-blocking SSL handshake step. Might run in a worker thread.
+
+    :return: None if the handshake is done or the raised exception
+    """
+    try:
+        ssl_sock.do_handshake()
+    except (ssl.SSLError, socket.error) as exc:
+        return exc
+    return None
+
+############################################################################
+############################################################################
+
+def _is_ip_address(host):
+    try:
+        socket.inet_aton(host)
+    except (socket.error, TypeError, ValueError):
+        return False
+    return True
+
 ############################################################################
 ############################################################################
 
@@ -64,17 +139,24 @@ class LinkSocket(object):
             raise RuntimeError("ssl module is not available")
         assert (sock is None) or isinstance(sock, socket.socket)
         self.sock = sock or self.create_socket()
+        self.fd = self.sock.fileno()  #: cached file descriptor
         self.ssl_config = ssl_config
+        self.is_ssl = ssl_config is not None
         self.remote_peer = remote_peer
 
-        self.is_connector = False  #: connector or listener
+        self.is_connector = False  #: connector or accepted connection
+        self.is_listener = False
         self.conn_id = None
+        self.poll_mask = 0  #: events the link is interested in
+        self.waiting_to_connect = False
+        self.in_ssl_handshake = False
+        self.handshake_future = None  #: running handshake step
         self.reset()
 
     #########################################################
 
     def reset(self):
-        self.write_buf = None  #: for SSL
+        self.write_buf = None  #: unsent rest of the last send
         self.last_send_size = 0
         self.send_finished = True
 
@@ -98,7 +180,7 @@ class LinkSocket(object):
     def accept(self):
         newsock, addr = self.sock.accept()
         newsock.setblocking(False)
-        if self.ssl_config is not None:
+        if self.is_ssl:
             newsock = ssl.wrap_socket(newsock, server_side=True,
                                       do_handshake_on_connect=False,
                                       ssl_version=self.ssl_config.ssl_version,
@@ -106,15 +188,20 @@ class LinkSocket(object):
                                       certfile=self.ssl_config.certfile,
                                       cert_reqs=self.ssl_config.cert_reqs,
                                       ca_certs=self.ssl_config.ca_certs)
+            # wrapping does not have to preserve the non-blocking mode
+            newsock.setblocking(False)
         newsock = LinkSocket(newsock, self.ssl_config)
         newsock.remote_peer = addr
         return newsock, addr
 
     #########################################################
 
-    def connect(self):
+    def connect(self, address=None):
+        """
+        :param address: resolved remote address, defaults to remote peer
+        """
         self.is_connector = True
-        if self.ssl_config is not None:
+        if self.is_ssl:
             self.sock = ssl.wrap_socket(self.sock, server_side=False,
                                       do_handshake_on_connect=False,
                                       ssl_version=self.ssl_config.ssl_version,
@@ -122,31 +209,50 @@ class LinkSocket(object):
                                       certfile=self.ssl_config.certfile,
                                       cert_reqs=self.ssl_config.cert_reqs,
                                       ca_certs=self.ssl_config.ca_certs)
-        return self.sock.connect_ex(self.remote_peer)
+            # wrapping does not have to preserve the non-blocking mode
+            self.sock.setblocking(False)
+        return self.sock.connect_ex(address or self.remote_peer)
 
     #########################################################
 
     def send(self, data):
         """
-        If data is ``None`` then ``self.write_buf`` is used.
+        Send as much as the kernel takes, the rest is kept in
+        ``self.write_buf``. If data is ``None`` then the rest is sent.
+        ``self.last_send_size`` accumulates over the continuations.
         """
-        if (data is not None) and not self.send_finished:
-            raise SendNotFinished(("previous send on %r is not finished, " +
-                              "wait for on_ready_to_send") % self)
-
-        data = data or self.write_buf
+        if data is None:
+            data = self.write_buf
+        else:
+            if not self.send_finished:
+                raise SendNotFinished(("previous send on %r is not finished, " +
+                                  "wait for on_ready_to_send") % self)
+            self.last_send_size = 0
 
         self.send_finished = False
-        if self.ssl_config is None:
-            self.last_send_size = self.sock.send(data)
+        try:
+            if not self.is_ssl:
+                sent = self.sock.send(data)
+            else:
+                sent = self.sock.write(data)
+        except ssl.SSLError as exc:
+            if exc.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+                raise
+            sent = 0
+        except socket.error as exc:
+            if exc.args[0] != errno.EWOULDBLOCK:
+                raise
+            sent = 0
+
+        self.last_send_size += sent
+        if sent == len(data):
+            self.write_buf = None
+        elif sent:
+            # slice without copying
+            self.write_buf = memoryview(data)[sent:]
         else:
-            try:
-                self.last_send_size = self.sock.write(data)
-                self.write_buf = None
-            except ssl.SSLError as exc:
-                if exc.args[0] != ssl.SSL_ERROR_WANT_WRITE:
-                    raise
-                self.write_buf = data
+            # SSL requires a repeated write with the same buffer
+            self.write_buf = data
 
     #########################################################
 
@@ -155,8 +261,13 @@ class LinkSocket(object):
 
     #########################################################
 
+    def recv_into(self, buf, length):
+        return self.sock.recv_into(buf, length)
+
+    #########################################################
+
     def fileno(self):
-        return self.sock.fileno()
+        return self.fd
 
     #########################################################
 
@@ -167,16 +278,24 @@ class LinkSocket(object):
             if exc.errno not in (errno.ENOTCONN, errno.ECONNRESET):
                 raise
         self.sock.close()
+        self.fd = -1
         if self.is_connector:
             self.reset()
             # closed socket cannot be reconnected so a new one must be created
             self.sock = self.create_socket()
+            self.fd = self.sock.fileno()
 
     #########################################################
 
     def create_ssl_context(self):
+        """
+        Create the SSL object if the non-blocking connect did not (py2).
+        """
         assert isinstance(self.sock, ssl.SSLSocket)
 
+        if self.sock._sslobj is not None:
+            return
+
         if hasattr(self.sock, "_sock"):
             raw_sock = self.sock._sock  # py2
         else:
@@ -205,7 +324,7 @@ class LinkSocket(object):
         :see: python documentation - ssl.SSLSocket.getpeercert()
         :return: peer's SSL certificate if available or None
         """
-        if self.ssl_config is None:
+        if not self.is_ssl:
             return None
         else:
             return self.sock._sslobj.peer_certificate(binary_form)
@@ -224,7 +343,15 @@ class Link(object):
         self.log = logging.getLogger("snakemq.link")
 
         self.reconnect_interval = RECONNECT_INTERVAL  #: in seconds
+        #: in seconds, cap for the exponential backoff of refused connects
+        self.reconnect_max_interval = RECONNECT_MAX_INTERVAL
+        #: give up connecting after this many refused connects, None - never
+        self.reconnect_max_attempts = None
         self.recv_block_size = RECV_BLOCK_SIZE
+        #: accepted connections beyond this many SSL handshakes are closed
+        self.max_handshakes = MAX_HANDSHAKES
+        #: max bytes taken by one send, the rest waits in the caller
+        self.max_write_buf = MAX_WRITE_BUF
 
         #{ callbacks
         self.on_connect = Callback()  #: ``func(conn_id)``
@@ -248,16 +375,36 @@ class Link(object):
 
         self._sock_by_fd = {}
         self._sock_by_conn = {}
+        #: (sock, conn_id) of fully finished sends waiting for on_ready_to_send
+        self._sends_done = deque()
+        #: sockets left with pending input by a bounded drain, edge-triggered
+        #: poll would not report them again
+        self._undrained = deque()
 
         self._listen_socks = {}  #: address:sock
-        self._listen_socks_filenos = set()
 
         self._connectors = {}  #: address:sock
-        self._socks_waiting_to_connect = set()
-        self._plannned_connections = []  #: (when, address)
+        #: heap of (when, seq, address), see :meth:`~.plan_connect`
+        self._plannned_connections = []
+        self._plans = {}  #: address:(when, seq) of the valid plan
+        self._plan_seq = 0  #: counter for plan ordering
         self._reconnect_intervals = {}  #: address:interval
-
-        self._in_ssl_handshake = set()  #: set of LinkSocket
+        self._reconnect_attempts = {}  #: address:count of refused connects
+        self._connector_hosts = {}  #: address:host given to add_connector
+        #: host:IP, kept after the connectors are deleted
+        self._resolved_hosts = {}
+        self._resolving = {}  #: host:token of a running background lookup
+        #: (host, token, IP, error) of finished lookups, thread-safe
+        self._resolves_done = deque()
+        #: finished lookups must not ring the bell after cleanup
+        self._resolve_lock = threading.Lock()
+
+        #: keep CPU heavy handshake steps out of the loop thread
+        self.use_thread_pool = ThreadPoolExecutor is not None
+        self._pool = None  #: created on first use, see :meth:`~.get_pool`
+        #: (LinkSocket, future) of finished handshake steps, thread-safe
+        self._handshakes_done = deque()
+        self._handshakes_count = 0  #: connections in SSL handshake
 
     ##########################################################
 
@@ -265,16 +412,38 @@ class Link(object):
         """
         Close all sockets and remove all connectors and listeners.
         """
+        with self._resolve_lock:
+            # running lookups are left to finish on their own
+            self._resolving.clear()
+        if self._pool is not None:
+            # running steps wake up the poll so the bell must be still open
+            self._pool.shutdown(wait=True)
+            self._pool = None
         self._poll_bell.close()
 
-        for address in list(self._connectors.keys()):
-            self.del_connector(address)
+        connectors = list(self._connectors.values())
+        self._connectors.clear()
+        self._reconnect_intervals.clear()  # prevents reconnect planning
+        self._reconnect_attempts.clear()
+        self._connector_hosts.clear()
+        self._resolved_hosts.clear()
+        self._plans.clear()
+        del self._plannned_connections[:]
+        for sock in connectors:
+            self.handle_close(sock)
 
-        for address in list(self._listen_socks.keys()):
-            self.del_listener(address)
+        listen_socks = list(self._listen_socks.values())
+        self._listen_socks.clear()
+        for sock in listen_socks:
+            del self._sock_by_fd[sock.fd]
+            sock.close()
 
         for sock in list(self._sock_by_fd.values()):
             self.handle_close(sock)
+        self._sends_done.clear()
+        self._undrained.clear()
+        self._handshakes_done.clear()
+        self._resolves_done.clear()
 
         assert not self._do_loop
 
@@ -282,12 +451,16 @@ class Link(object):
         assert len(self._sock_by_fd) == 0
         assert len(self._sock_by_conn) == 0
         assert len(self._listen_socks) == 0
-        assert len(self._listen_socks_filenos) == 0
         assert len(self._connectors) == 0
-        assert len(self._socks_waiting_to_connect) == 0
-        assert len(self._plannned_connections) == 0
+        assert len(self._plans) == 0
         assert len(self._reconnect_intervals) == 0
-        assert len(self._in_ssl_handshake) == 0
+        assert len(self._reconnect_attempts) == 0
+        assert len(self._connector_hosts) == 0
+        assert len(self._resolved_hosts) == 0
+        assert len(self._resolving) == 0
+        assert self._handshakes_count == 0
+        assert len(self._handshakes_done) == 0
+        assert len(self._resolves_done) == 0
 
     ##########################################################
 
@@ -296,15 +469,22 @@ class Link(object):
         This will not create an immediate connection. It just adds a connector
         to the pool.
 
-        :param address: remote address
+        :param address: remote address, the host is resolved again in the
+            background if the connection is refused
         :param reconnect_interval: reconnect interval in seconds
-        :return: connector address (use it for deletion)
+        :return: connector address (resolved, use it for deletion)
         """
-        address = socket.gethostbyname(address[0]), address[1]
+        host = address[0]
+        ip = self._resolved_hosts.get(host)
+        if ip is None:
+            ip = socket.gethostbyname(host)
+            self._resolved_hosts[host] = ip
+        address = ip, address[1]
         if address in self._connectors:
             raise ValueError("connector '%r' already set", address)
         sock = LinkSocket(remote_peer=address, ssl_config=ssl_config)
         self._connectors[address] = sock
+        self._connector_hosts[address] = host
         self._reconnect_intervals[address] = \
                 reconnect_interval or self.reconnect_interval
         self.plan_connect(0, address)  # connect ASAP
@@ -317,14 +497,12 @@ class Link(object):
         Delete connector.
         """
         sock = self._connectors.pop(address)
-        self._socks_waiting_to_connect.discard(sock)
         del self._reconnect_intervals[address]
+        self._reconnect_attempts.pop(address, None)
+        del self._connector_hosts[address]
 
-        # filter out address from plan
-        self._plannned_connections[:] = \
-            [(when, _address)
-                  for (when, _address) in self._plannned_connections
-                  if _address != address]
+        # the plan item is left in the heap, deal_connects() skips it
+        self._plans.pop(address, None)
 
         self.handle_close(sock)
 
@@ -344,11 +522,11 @@ class Link(object):
         if address[1] == 0:
             address = listen_sock.sock.getsockname()
 
-        fileno = listen_sock.fileno()
+        fileno = listen_sock.fd
         self._sock_by_fd[fileno] = listen_sock
         self._listen_socks[address] = listen_sock
-        self._listen_socks_filenos.add(fileno)
-        self.poller.register(listen_sock, select.EPOLLIN)
+        listen_sock.is_listener = True
+        self.register_sock(listen_sock, select.EPOLLIN)
 
         self.log.debug("add_listener fd=%i %r" % (fileno, address))
         return address
@@ -360,8 +538,7 @@ class Link(object):
         Delete listener.
         """
         sock = self._listen_socks.pop(address)
-        fileno = sock.fileno()
-        self._listen_socks_filenos.remove(fileno)
+        fileno = sock.fd
         del self._sock_by_fd[fileno]
         sock.close()
 
@@ -371,7 +548,7 @@ class Link(object):
         """
         Thread-safe.
         """
-        self._poll_bell.write(b"a")
+        self._poll_bell.ring()
 
     ##########################################################
 
@@ -383,26 +560,45 @@ class Link(object):
         This operation is non-blocking, data might be lost if you close
         connection before proper delivery. Always wait for
         :py:attr:`~.on_ready_to_send` to have confirmation about successful
-        send and information about amount of sent data.
+        send and information about amount of sent data. If the whole data
+        were accepted at once then the callback is called at the end of the
+        current poll round. At most :attr:`~.max_write_buf` bytes are taken
+        in one send.
 
         Do not feed this method with large bulks of data in MS Windows. It
         sometimes blocks for a little time even in non-blocking mode.
 
         Optimal data size is 16k-64k.
         """
+        sock = self._sock_by_conn[conn_id]
+        if len(data) > self.max_write_buf:
+            data = memoryview(data)[:self.max_write_buf]
+        if self.sock_send(sock, data):
+            # the kernel took everything, no need to poll for EPOLLOUT
+            self._sends_done.append((sock, conn_id))
+
+    ##########################################################
+
+    def sock_send(self, sock, data):
+        """
+        Send data (or the unsent rest if data is ``None``) and wait for
+        EPOLLOUT if the kernel did not take everything.
+
+        :return: True if the whole data were sent
+        """
         try:
-            sock = self._sock_by_conn[conn_id]
             sock.send(data)
-            self.poller.modify(sock, select.EPOLLIN | select.EPOLLOUT)
         except socket.error as exc:
             err = exc.args[0]
-            if err == errno.EWOULDBLOCK:
-                pass # ignore it, make caller to wait for "ready to send"
-            elif err in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+            if err in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
                         errno.ECONNABORTED, errno.EPIPE, errno.EBADF):
                 self.handle_close(sock)
-            else:
-                raise
+                return False
+            raise
+        if sock.write_buf is None:
+            return True
+        self.set_poll_mask(sock, select.EPOLLIN | select.EPOLLOUT)
+        return False
 
     ##########################################################
 
@@ -461,21 +657,49 @@ class Link(object):
     def new_connection_id(self, sock):
         """
         Create a virtual connection ID. This ID will be passed to ``on_*``
-        functions. It is a unique identifier for every new connection during
-        the instance's existence.
+        functions. It is a unique identifier (an integer) for every new
+        connection during the instance's existence.
         """
         # NOTE e.g. pair address+port can't be used as a connection identifier
         # because it is not unique enough. It might be the same for 2 connections
         # distinct in time.
 
         self._new_conn_id += 1
-        conn_id = "%ifd%i" % (self._new_conn_id, sock.fileno())
+        conn_id = self._new_conn_id
         sock.conn_id = conn_id
         self._sock_by_conn[conn_id] = sock
         return conn_id
 
     ##########################################################
 
+    def register_sock(self, sock, mask):
+        sock.poll_mask = mask
+        self.poller.register(sock.fd, mask | POLL_EDGE)
+
+    ##########################################################
+
+    def set_poll_mask(self, sock, mask):
+        """
+        Change events the socket is polled for.
+        """
+        if mask == sock.poll_mask:
+            return
+        sock.poll_mask = mask
+        self.poller.modify(sock.fd, mask | POLL_EDGE)
+
+    ##########################################################
+
+    def get_pool(self):
+        """
+        :return: thread pool, None if :attr:`~.use_thread_pool` is off or
+                 the pool is not available
+        """
+        if (self._pool is None) and self.use_thread_pool:
+            self._pool = ThreadPoolExecutor(max_workers=cpu_count() or 1)
+        return self._pool
+
+    ##########################################################
+
     def del_connection_id(self, sock):
         conn_id = sock.conn_id
         del self._sock_by_conn[conn_id]
@@ -484,9 +708,42 @@ class Link(object):
     ##########################################################
 
     def plan_connect(self, when, address):
-        item = (when, address)
-        idx = bisect.bisect(self._plannned_connections, item)
-        self._plannned_connections.insert(idx, item)
+        """
+        Plan a connect. Only the earliest plan for the address is kept.
+        """
+        previous = self._plans.get(address)
+        if (previous is not None) and (previous[0] <= when):
+            return
+        self._plan_seq += 1
+        self._plans[address] = (when, self._plan_seq)
+        plan = self._plannned_connections
+        heapq.heappush(plan, (when, self._plan_seq, address))
+        if len(plan) > 2 * len(self._plans) + MAX_STALE_PLANS:
+            # drop the cancelled and replaced plans
+            plan[:] = [when_seq + (addr,)
+                        for addr, when_seq in self._plans.items()]
+            heapq.heapify(plan)
+
+    ##########################################################
+
+    def tune_socket(self, sock):
+        """
+        Set options of a connection socket. Nagle's algorithm is disabled
+        because the messages are framed by the packeter anyway. Kernel
+        buffers are set only if they can not hold one receive block, a fixed
+        size turns off the kernel's automatic tuning.
+        """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            if (sock.getsockopt(socket.SOL_SOCKET, option) <
+                  self.recv_block_size):
+                sock.setsockopt(socket.SOL_SOCKET, option,
+                                self.recv_block_size)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("socket buffers fd=%i rcvbuf=%i sndbuf=%i" %
+                      (sock.fileno(),
+                      sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                      sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)))
 
     ##########################################################
 
@@ -496,11 +753,13 @@ class Link(object):
         :return: True if connected
         """
         sock = self._connectors[address]
-        err = sock.connect()
+        self.tune_socket(sock.sock)
+        ip = self._resolved_hosts[self._connector_hosts[address]]
+        err = sock.connect((ip, address[1]))
 
-        self.poller.register(sock)
-        self._sock_by_fd[sock.fileno()] = sock
-        self._socks_waiting_to_connect.add(sock)
+        self.register_sock(sock, select.EPOLLIN | select.EPOLLOUT)
+        self._sock_by_fd[sock.fd] = sock
+        sock.waiting_to_connect = True
 
         if err in (0, errno.EISCONN):
             self.handle_connect(sock)
@@ -515,103 +774,206 @@ class Link(object):
     ##########################################################
 
     def ssl_handshake(self, sock):
-        failed = False
-        err = None
-
+        """
+        Make a handshake step. If the handshake pool is available then the
+        step is only started and its result is processed later by
+        :meth:`~.deal_handshakes`.
+        """
         if sock.sock._sslobj is None:
-            self._in_ssl_handshake.remove(sock)
+            # this might be caused by SSL-wrapping a socket with not
+            # fully created connection (like if you nmap a port)
+            self.end_ssl_handshake(sock)
             return SSL_HANDSHAKE_FAILED
 
-        try:
-            if sock.sock._sslobj is None:
-                # this might be caused by SSL-wrapping a socket with not
-                # fully created connection (like if you nmap a port)
-                failed = True
-                err = "no _sslobj"
-            else:
-                sock.sock.do_handshake()
-        except ssl.SSLError as exc:
-            err = exc
-            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
-                self.poller.modify(sock, select.EPOLLIN)
-            elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
-                self.poller.modify(sock, select.EPOLLOUT)
-            else:
-                failed = True
-        except socket.error as exc:
-            err = exc
-            failed = True
-        else:
-            self._in_ssl_handshake.remove(sock)
-            self.poller.modify(sock, select.EPOLLIN)
+        if sock.handshake_future is not None:
+            return SSL_HANDSHAKE_IN_PROGRESS
+
+        if self._pool is None:
+            res = self.handle_ssl_handshake(sock, _do_handshake(sock.sock))
+            if res == SSL_HANDSHAKE_DONE:
+                # data which came with the peer's last handshake flight
+                # used up the edge, read them in this round
+                self._undrained.append(sock)
+            return res
+
+        def on_done(future):
+            self._handshakes_done.append((sock, future))
+            self.wakeup_poll()
+
+        # the mask is kept, events which come while the worker owns the
+        # socket are ignored and the socket is reevaluated by
+        # deal_handshakes()
+        future = self._pool.submit(_do_handshake, sock.sock)
+        sock.handshake_future = future
+        future.add_done_callback(on_done)
+        return SSL_HANDSHAKE_IN_PROGRESS
+
+    ##########################################################
+
+    def handle_ssl_handshake(self, sock, err):
+        """
+        Process result of a handshake step.
+
+        :param err: exception raised by the step or None
+        """
+        if err is None:
+            self.end_ssl_handshake(sock)
+            self.set_poll_mask(sock, select.EPOLLIN)
             self.log.debug("SSL handshake done %s, cipher=%r" %
                             (sock.conn_id, sock.sock.cipher()))
             return SSL_HANDSHAKE_DONE
 
-        if failed:
-            self.log.error("SSL handshake %s: %r" % (sock.conn_id, err))
-            self.handle_close(sock)
-            self._in_ssl_handshake.remove(sock)
-            return SSL_HANDSHAKE_FAILED
+        if isinstance(err, ssl.SSLError):
+            code = err.args[0]
+            mask = None
+            if code == ssl.SSL_ERROR_WANT_READ:
+                mask = select.EPOLLIN
+            elif code == ssl.SSL_ERROR_WANT_WRITE:
+                mask = select.EPOLLOUT
+            if mask is not None:
+                # the poller is touched only if the mask differs
+                self.set_poll_mask(sock, mask)
+                return SSL_HANDSHAKE_IN_PROGRESS
+
+        self.log.error("SSL handshake %s: %r" % (sock.conn_id, err))
+        self.handle_close(sock)
+        self.end_ssl_handshake(sock)
+        return SSL_HANDSHAKE_FAILED
 
-        return SSL_HANDSHAKE_IN_PROGRESS
+    ##########################################################
+
+    def begin_ssl_handshake(self, sock):
+        self.get_pool()
+        sock.in_ssl_handshake = True
+        self._handshakes_count += 1
+        return self.ssl_handshake(sock)
+
+    ##########################################################
+
+    def end_ssl_handshake(self, sock):
+        if sock.in_ssl_handshake:
+            sock.in_ssl_handshake = False
+            self._handshakes_count -= 1
+
+    ##########################################################
+
+    def deal_handshakes(self):
+        while self._handshakes_done:
+            sock, future = self._handshakes_done.popleft()
+            if sock.handshake_future is not future:
+                continue  # socket was closed meanwhile
+            sock.handshake_future = None
+            mask = sock.poll_mask
+            res = self.handle_ssl_handshake(sock, future.result())
+            if res == SSL_HANDSHAKE_FAILED:
+                continue
+            if sock.poll_mask == mask:
+                # edges which came during the step were ignored, a changed
+                # mask would make the poll reevaluate the socket anyway
+                self.poller.modify(sock.fd, mask | POLL_EDGE)
+            if res == SSL_HANDSHAKE_DONE:
+                # connection is ready for user IO
+                self.on_connect(sock.conn_id)
 
     ##########################################################
 
     def handle_connect(self, sock):
-        self._socks_waiting_to_connect.remove(sock)
+        sock.waiting_to_connect = False
+        self._reconnect_attempts.pop(sock.remote_peer, None)
         conn_id = self.new_connection_id(sock)
-        self.log.info("connect %s %r" % (conn_id, sock.remote_peer))
+        self.log.info("connect %i fd=%i %r" %
+                        (conn_id, sock.fd, sock.remote_peer))
 
         handshake_res = SSL_HANDSHAKE_IN_PROGRESS
-        if sock.ssl_config:
+        if sock.is_ssl:
             sock.create_ssl_context()
-            self._in_ssl_handshake.add(sock)
-            handshake_res = self.ssl_handshake(sock)
+            # the handshake sets the poll mask on its own
+            handshake_res = self.begin_ssl_handshake(sock)
             if handshake_res == SSL_HANDSHAKE_FAILED:
                 return
+        else:
+            self.set_poll_mask(sock, select.EPOLLIN)
 
-        self.poller.modify(sock, select.EPOLLIN)
-
-        if (sock.ssl_config is None) or (handshake_res == SSL_HANDSHAKE_DONE):
+        if (not sock.is_ssl) or (handshake_res == SSL_HANDSHAKE_DONE):
             self.on_connect(conn_id)
 
     ##########################################################
 
     def handle_accept(self, sock):
-        try:
-            newsock, address = sock.accept()
-        except socket.error as exc:
-            self.log.error("accept %r: %r" % (sock, exc))
+        # accept everything pending, the edge is reported only once
+        for _ in range(MAX_ACCEPT_DRAIN):
+            try:
+                newsock, address = sock.accept()
+            except socket.error as exc:
+                if exc.args[0] != errno.EWOULDBLOCK:
+                    self.log.error("accept %r: %r" % (sock, exc))
+                return
+            self.handle_new_conn(newsock, address)
+        self._undrained.append(sock)
+
+    ##########################################################
+
+    def handle_new_conn(self, newsock, address):
+        if newsock.is_ssl and (self._handshakes_count >= self.max_handshakes):
+            self.log.error("accept %r: too many SSL handshakes" % (address,))
+            newsock.close()
             return
 
+        self.tune_socket(newsock.sock)
         conn_id = self.new_connection_id(newsock)
-        self.log.info("accept %s %r" % (conn_id, address))
+        self.log.info("accept %i fd=%i %r" % (conn_id, newsock.fd, address))
 
-        self._sock_by_fd[newsock.fileno()] = newsock
-        self.poller.register(newsock, select.EPOLLIN)
+        self._sock_by_fd[newsock.fd] = newsock
+        # SSL handshake sets the mask on its own
+        self.register_sock(newsock, 0 if newsock.is_ssl else select.EPOLLIN)
 
         handshake_res = SSL_HANDSHAKE_IN_PROGRESS
-        if newsock.ssl_config:
-            self._in_ssl_handshake.add(newsock)
-            handshake_res = self.ssl_handshake(newsock)
+        if newsock.is_ssl:
+            handshake_res = self.begin_ssl_handshake(newsock)
             if handshake_res == SSL_HANDSHAKE_FAILED:
                 return
 
-        if (newsock.ssl_config is None) or (handshake_res == SSL_HANDSHAKE_DONE):
+        if (not newsock.is_ssl) or (handshake_res == SSL_HANDSHAKE_DONE):
             self.on_connect(conn_id)
 
     ##########################################################
 
-    def handle_recv(self, sock):
+    def handle_recv(self, sock, hangup=False):
+        """
+        :param hangup: the peer shut down its side, read until EOF
+        """
         conn_id = sock.conn_id
         if conn_id is None:
             # socket could be closed in one poll round before recv
             return
 
-        # do not put it in a draining cycle to avoid other links starvation
+        buf = _acquire_recv_buf(self.recv_block_size)
         try:
-            fragment = sock.recv(self.recv_block_size)
+            view = memoryview(buf)
+            # drain only a limited amount to avoid other links starvation
+            for _ in range(MAX_RECV_DRAIN):
+                received = self._recv_into(sock, conn_id, view)
+                if (not received) or (sock.conn_id is None):
+                    # drained or closed
+                    break
+                if ((received < self.recv_block_size) and
+                      not (sock.is_ssl or hangup)):
+                    # short read, the socket is drained (SSL returns only
+                    # a single record)
+                    break
+            else:
+                self._undrained.append(sock)
+        finally:
+            _release_recv_buf(buf)
+
+    ##########################################################
+
+    def _recv_into(self, sock, conn_id, view):
+        """
+        :return: count of received bytes
+        """
+        try:
+            received = sock.recv_into(view, self.recv_block_size)
         except ssl.SSLError as exc:
             if exc.args[0] != ssl.SSL_ERROR_WANT_READ:
                 raise
@@ -627,38 +989,114 @@ class Link(object):
             elif err != errno.EWOULDBLOCK:
                 raise
         else:
-            if fragment:
-                self.log.debug("recv %s len=%i" % (conn_id, len(fragment)))
+            if received:
+                fragment = view[:received].tobytes()
+                self.log.debug("recv %s len=%i" % (conn_id, received))
                 self.on_recv(conn_id, fragment)
+                return received
             else:
                 self.handle_close(sock)
+        return 0
 
     ##########################################################
 
     def handle_conn_refused(self, sock):
-        self._socks_waiting_to_connect.remove(sock)
-        self.poller.unregister(sock)
-        del self._sock_by_fd[sock.fileno()]
+        sock.waiting_to_connect = False
+        self.poller.unregister(sock.fd)
+        del self._sock_by_fd[sock.fd]
         sock.close()
 
         address = sock.remote_peer
-        self.plan_connect(time.time() + self._reconnect_intervals[address],
-                          address)
+        # the host might have moved
+        host = self._connector_hosts.get(address)
+        if host is not None:
+            self.resolve(host)
+        self.plan_reconnect(address)
+
+    ##########################################################
+
+    def resolve(self, host):
+        """
+        Resolve the host again in a background thread, the result is
+        processed by :meth:`~.deal_resolves`.
+        """
+        if (host in self._resolving) or _is_ip_address(host):
+            return
+        token = object()
+        self._resolving[host] = token
+
+        def lookup():
+            try:
+                result = (socket.gethostbyname(host), None)
+            except socket.error as exc:
+                result = (None, exc)
+            with self._resolve_lock:
+                if self._resolving.get(host) is token:
+                    self._resolves_done.append((host, token) + result)
+                    self.wakeup_poll()
+
+        thread = threading.Thread(target=lookup, name="snakemq-resolve")
+        thread.daemon = True  # a slow resolver must not block the exit
+        thread.start()
+
+    ##########################################################
+
+    def deal_resolves(self):
+        while self._resolves_done:
+            host, token, ip, exc = self._resolves_done.popleft()
+            if self._resolving.get(host) is not token:
+                continue
+            del self._resolving[host]
+            if exc is not None:
+                self.log.error("resolve %r: %r" % (host, exc))
+            else:
+                self._resolved_hosts[host] = ip
+
+    ##########################################################
+
+    def plan_reconnect(self, address):
+        """
+        Plan the next connection attempt after a failed one.
+        """
+        attempts = self._reconnect_attempts.get(address, 0) + 1
+        self._reconnect_attempts[address] = attempts
+        if ((self.reconnect_max_attempts is not None) and
+              (attempts >= self.reconnect_max_attempts)):
+            self.log.error("connect %r: giving up after %i attempts" %
+                            (address, attempts))
+            return
+
+        # exponential backoff with a jitter to avoid reconnect storms
+        interval = self._reconnect_intervals[address]
+        # the cap never shortens the configured interval
+        delay = min(max(self.reconnect_max_interval, interval),
+                    interval * 2 ** min(attempts - 1, 30))
+        delay += random.random() * interval
+        self.plan_connect(time.time() + delay, address)
 
     ##########################################################
 
     def handle_close(self, sock):
-        fileno = sock.fileno()
+        future = sock.handshake_future
+        if future is not None:
+            sock.handshake_future = None
+            if not future.cancel():
+                # the step is short, do not close the socket under its hands
+                future.result()
+
+        fileno = sock.fd
         if fileno in self._sock_by_fd:
-            self.poller.unregister(sock)
+            self.poller.unregister(fileno)
             del self._sock_by_fd[fileno]
         sock.close()
 
         if sock.conn_id is not None:
             self.log.info("disconnect %s " % sock.conn_id)
-            if (sock.ssl_config is None) or (sock not in self._in_ssl_handshake):
+            if not sock.in_ssl_handshake:
                 self.on_disconnect(sock.conn_id)
             self.del_connection_id(sock)
+        self.end_ssl_handshake(sock)
+        sock.waiting_to_connect = False
 
         if sock.is_connector:
             address = sock.remote_peer
@@ -669,20 +1107,20 @@ class Link(object):
     ##########################################################
 
     def handle_ready_to_send(self, sock):
-        if sock.write_buf is None:
-            sock.send_finished = True
-            self.poller.modify(sock, select.EPOLLIN)
-            self.log.debug("ready to send %s (last send len=%i)" %
-                            (sock.conn_id, sock.last_send_size))
-            self.on_ready_to_send(sock.conn_id, sock.last_send_size)
-        else:
-            self.log.debug("ready to send %s, repeat" % sock.conn_id)
-            sock.send(None)  # repeat last buffer
+        if sock.write_buf is not None:
+            self.log.debug("ready to send %s, continue" % sock.conn_id)
+            if not self.sock_send(sock, None):
+                return
+        sock.send_finished = True
+        self.set_poll_mask(sock, select.EPOLLIN)
+        self.log.debug("ready to send %s (last send len=%i)" %
+                        (sock.conn_id, sock.last_send_size))
+        self.on_ready_to_send(sock.conn_id, sock.last_send_size)
 
     ##########################################################
 
     def handle_sock_err(self, sock):
-        if sock in self._socks_waiting_to_connect:
+        if sock.waiting_to_connect:
             self.handle_conn_refused(sock)
         else:
             self.handle_close(sock)
@@ -691,38 +1129,41 @@ class Link(object):
 
     def handle_sock_io(self, fd, sock, mask):
         if mask & select.EPOLLOUT:
-            if sock in self._socks_waiting_to_connect:
+            if sock.waiting_to_connect:
                 self.handle_connect(sock)
             else:
                 self.handle_ready_to_send(sock)
         if mask & select.EPOLLIN:
-            if fd in self._listen_socks_filenos:
+            if sock.is_listener:
                 self.handle_accept(sock)
             else:
-                self.handle_recv(sock)
+                self.handle_recv(sock, mask & select.EPOLLRDHUP)
 
     ##########################################################
 
     def handle_fd_mask(self, fd, mask):
         if fd == self._poll_bell.r:
             assert mask & select.EPOLLIN
-            self._poll_bell.read(BELL_READ)  # flush the pipe
+            self._poll_bell.flush()
+            self.deal_handshakes()
+            self.deal_resolves()
         else:
             # socket might have been already discarded by the Link
             # so this pass might be skipped
-            if fd not in self._sock_by_fd:
+            sock = self._sock_by_fd.get(fd)
+            if sock is None:
                 return
-            sock = self._sock_by_fd[fd]
 
-            if mask & (select.EPOLLERR | select.EPOLLHUP):
+            if mask & POLL_ERR:
                 self.handle_sock_err(sock)
+                return
+
+            if sock.in_ssl_handshake:
+                if self.ssl_handshake(sock) == SSL_HANDSHAKE_DONE:
+                    # connection is ready for user IO
+                    self.on_connect(sock.conn_id)
             else:
-                if sock in self._in_ssl_handshake:
-                    if self.ssl_handshake(sock) == SSL_HANDSHAKE_DONE:
-                        # connection is ready for user IO
-                        self.on_connect(sock.conn_id)
-                else:
-                    self.handle_sock_io(fd, sock, mask)
+                self.handle_sock_io(fd, sock, mask)
 
     ##########################################################
 
@@ -730,29 +1171,64 @@ class Link(object):
         """
         :return: values returned by poll
         """
-        fds = []
+        if self._sends_done or self._undrained:
+            # do not block, on_ready_to_send or recv is already due
+            poll_timeout = 0
+
         try:
-            fds[:] = self.poller.poll(poll_timeout)
+            fds = self.poller.poll(poll_timeout, MAX_POLL_EVENTS)
         except IOError as exc:
             if exc.errno != errno.EINTR:  # hibernate does that
                 raise
+            fds = []
 
+        handle_fd_mask = self.handle_fd_mask
         for fd, mask in fds:
-            self.handle_fd_mask(fd, mask)
+            handle_fd_mask(fd, mask)
+        self.deal_sends_done()
+        self.deal_undrained()
         return fds
 
     ##########################################################
 
+    def deal_sends_done(self):
+        # sends made by the callbacks are left for the next round
+        for _ in range(len(self._sends_done)):
+            sock, conn_id = self._sends_done.popleft()
+            if sock.conn_id == conn_id:  # might have been closed
+                self.handle_ready_to_send(sock)
+
+    ##########################################################
+
+    def deal_undrained(self):
+        # other sockets had their turn, continue with the bounded drains
+        for _ in range(len(self._undrained)):
+            sock = self._undrained.popleft()
+            if self._sock_by_fd.get(sock.fd) is not sock:
+                continue  # closed meanwhile
+            if sock.is_listener:
+                self.handle_accept(sock)
+            else:
+                # the hangup flag of the original event is not known
+                self.handle_recv(sock, hangup=True)
+
+    ##########################################################
+
     def deal_connects(self):
         now = time.time()
-        to_remove = 0
-        for when, address in self._plannned_connections:
-            reconnect_interval = self._reconnect_intervals[address]
-            if (when <= now) or (when > now + reconnect_interval * 2):
-                to_remove += 1
+        plan = self._plannned_connections
+        while plan:
+            when, seq, address = plan[0]
+            if self._plans.get(address) != (when, seq):
+                # cancelled or replaced plan
+                heapq.heappop(plan)
+                continue
+            max_delay = max(self._reconnect_intervals[address],
+                            self.reconnect_max_interval) * 2
+            # the latter condition handles system time jumps
+            if (when <= now) or (when > now + max_delay):
+                heapq.heappop(plan)
+                del self._plans[address]
                 self.connect(address)
             else:
                 break
-
-        if to_remove:
-            del self._plannned_connections[:to_remove]
@@ -2,6 +2,7 @@
 """
 Stupid poll implementation for non-epoll systems.
 Wrapper for select. Not working for file descriptors.
+Edge-triggered mode is not supported, EPOLLET is ignored.
 """
 
 import select
@@ -14,6 +15,10 @@ if not hasattr(select, "epoll"):
     select.EPOLLOUT = 4
     select.EPOLLERR = 8
     select.EPOLLHUP = 16
+    select.EPOLLET = 1 << 31
+
+if not hasattr(select, "EPOLLRDHUP"):
+    select.EPOLLRDHUP = 0x2000  # missing in older Pythons
 
 #########################################################################
 
@@ -44,9 +49,10 @@ class SelectPoll(object):
             fd = obj
         return fd
 
-    def poll(self, timeout):
+    def poll(self, timeout, maxevents=-1):
         """
         :param timeout: seconds
+        :param maxevents: max number of returned events, -1 means unlimited
         """
         if len(self.fds) == 0:
             time.sleep(timeout)
@@ -73,7 +79,11 @@ class SelectPoll(object):
         for fd in xlist:
             res[fd] = res.get(fd, 0) | select.EPOLLERR
 
-        return res.items()
+        res = list(res.items())
+        if maxevents > 0:
+            # the rest will be reported by the next poll
+            del res[maxevents:]
+        return res
 
 #########################################################################
 
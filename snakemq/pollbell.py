@@ -17,6 +17,11 @@ if os.name != "nt":
 ############################################################################
 ############################################################################
 
+BELL_READ = 1024  #: flush size of stream based bells
+
+############################################################################
+############################################################################
+
 class BellBase(object):
     def __init__(self):
         self.r = None
@@ -25,6 +30,18 @@ class BellBase(object):
     def wait(self, timeout=1):
         select.select([self.r], [], [], timeout)
 
+    def ring(self):
+        """
+        Make the read part readable. Thread-safe.
+        """
+        self.write(b"a")
+
+    def flush(self):
+        """
+        Make the read part not readable until the next ring.
+        """
+        self.read(BELL_READ)
+
     def __repr__(self):
         return "<%s %x r=%r w=%r>" % (self.__class__.__name__,
                                       id(self), self.r, self.w)
@@ -51,6 +68,26 @@ class PosixBell(BellBase):
 ############################################################################
 ############################################################################
 
+class EventfdBell(BellBase):
+    """
+    Linux eventfd counter. Any number of rings is flushed by a single read.
+    """
+    def __init__(self):
+        BellBase.__init__(self)
+        self.r = self.w = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+    def ring(self):
+        os.eventfd_write(self.w, 1)
+
+    def flush(self):
+        os.eventfd_read(self.r)
+
+    def close(self):
+        os.close(self.r)
+
+############################################################################
+############################################################################
+
 class WinBell(BellBase):
     """
     WinBell is no bell.
@@ -92,5 +129,7 @@ class WinBell(BellBase):
 
 if os.name == "nt":
     Bell = WinBell
+elif hasattr(os, "eventfd"):  # Linux, python >= 3.10
+    Bell = EventfdBell
 else:
     Bell = PosixBell
@@ -12,7 +12,9 @@ except ImportError:
 import os
 import errno
 import threading
+import time
 import socket
+import select
 import sys
 
 import mock
@@ -20,6 +22,7 @@ from nose.tools import timed
 
 import snakemq.link
 import snakemq.poll
+import snakemq.pollbell
 
 import utils
 
@@ -52,9 +55,10 @@ class TestConnector(utils.TestCase):
 
     def test_connector_cleanup(self):
         addr = self.link.add_connector(("localhost", TEST_PORT))
+        sock = self.link._connectors[addr]
         self.link.connect(addr)
         self.link.del_connector(addr)
-        self.assertEqual(len(self.link._socks_waiting_to_connect), 0)
+        self.assertFalse(sock.waiting_to_connect)
 
     ########################################################
 
@@ -73,7 +77,120 @@ class TestConnector(utils.TestCase):
         # just make sure that the connection failed
         self.assertEqual(link_w.connect.call_count, 1)
         self.assertEqual(link_w.handle_conn_refused.call_count, 1)
-        self.assertEqual(len(self.link._socks_waiting_to_connect), 0)
+        self.assertFalse(self.link._connectors[addr].waiting_to_connect)
+        self.link.del_connector(addr)
+
+    ########################################################
+
+    def test_reconnect_backoff(self):
+        addr = self.link.add_connector(("localhost", TEST_PORT),
+                                        reconnect_interval=1.0)
+        self.link.reconnect_max_interval = 3.0
+        self.link.reconnect_max_attempts = 4
+        self.link.poller = mock.Mock()
+        self.link.plan_connect = mock.Mock()
+        sock = mock.Mock()
+        sock.remote_peer = addr
+        delays = []
+        for _ in range(4):
+            sock.waiting_to_connect = True
+            self.link._sock_by_fd[sock.fd] = sock
+            with mock.patch("time.time", return_value=0.0):
+                self.link.handle_conn_refused(sock)
+            if self.link.plan_connect.called:
+                delays.append(self.link.plan_connect.call_args[0][0])
+                self.link.plan_connect.reset_mock()
+        # 1, 2, 3 (capped) + jitter, then give up
+        self.assertEqual(len(delays), 3)
+        for delay, low in zip(delays, (1.0, 2.0, 3.0)):
+            self.assertTrue(low <= delay < low + 1.0, delays)
+
+        # interval above the cap is kept
+        self.link._reconnect_intervals[addr] = 10.0
+        self.link._reconnect_attempts.clear()
+        for _ in range(2):
+            sock.waiting_to_connect = True
+            self.link._sock_by_fd[sock.fd] = sock
+            with mock.patch("time.time", return_value=0.0):
+                self.link.handle_conn_refused(sock)
+            delay = self.link.plan_connect.call_args[0][0]
+            self.assertTrue(10.0 <= delay < 20.0, delay)
+        self.link.del_connector(addr)
+
+    ########################################################
+
+    def test_resolve_in_background(self):
+        threads = []
+        def gethostbyname(host):
+            threads.append(threading.current_thread())
+            return "127.0.0.%i" % len(threads)
+
+        with mock.patch("socket.gethostbyname", gethostbyname):
+            # resolved once by the caller
+            addr = self.link.add_connector(("somehost", TEST_PORT))
+            self.assertEqual(addr, ("127.0.0.1", TEST_PORT))
+            self.assertEqual(self.link._resolved_hosts,
+                              {"somehost": "127.0.0.1"})
+            self.assertEqual(threads, [threading.current_thread()])
+
+            # refused connection resolves the host again in a thread
+            self.link.connect(addr)
+            for _ in range(10):
+                if self.link._resolved_hosts["somehost"] == "127.0.0.2":
+                    break
+                self.link.poll(0.2)
+            self.assertEqual(self.link._resolved_hosts["somehost"],
+                              "127.0.0.2")
+            self.assertEqual(len(threads), 2)
+            self.assertNotEqual(threads[1], threading.current_thread())
+            self.assertEqual(len(self.link._resolving), 0)
+            self.assertEqual(self.link._pool, None)
+
+            # the cache survives the delete
+            self.link.del_connector(addr)
+            addr = self.link.add_connector(("somehost", TEST_PORT))
+            self.assertEqual(addr, ("127.0.0.2", TEST_PORT))
+            self.assertEqual(len(threads), 2)
+
+            # IP literals are never looked up in the background
+            self.link.resolve("127.0.0.1")
+            self.assertEqual(len(self.link._resolving), 0)
+            self.assertEqual(len(threads), 2)
+
+    def test_connector_duplicate_by_ip(self):
+        self.link.add_connector(("localhost", TEST_PORT))
+        self.assertRaises(ValueError, self.link.add_connector,
+                          (socket.gethostbyname("localhost"), TEST_PORT))
+
+    ########################################################
+
+    def test_planned_connections(self):
+        addr = self.link.add_connector(("localhost", TEST_PORT))
+        self.link.connect = mock.Mock()
+        # replaced plan
+        self.link.plan_connect(0, addr)
+        self.link.deal_connects()
+        self.assertEqual(self.link.connect.call_count, 1)
+        self.assertEqual(len(self.link._plannned_connections), 0)
+        # cancelled plan
+        self.link.plan_connect(0, addr)
+        self.link.del_connector(addr)
+        self.link.deal_connects()
+        self.assertEqual(self.link.connect.call_count, 1)
+        self.assertEqual(len(self.link._plannned_connections), 0)
+
+    ########################################################
+
+    def test_earliest_plan(self):
+        addr = self.link.add_connector(("localhost", TEST_PORT))
+        self.link.plan_connect(10, addr)
+        self.assertEqual(self.link._plans[addr][0], 0)
+        # stale plans do not pile up
+        for when in range(-1, -1000, -1):
+            self.link.plan_connect(when, addr)
+        self.assertEqual(self.link._plans[addr][0], -999)
+        self.assertLessEqual(len(self.link._plannned_connections),
+                              2 + snakemq.link.MAX_STALE_PLANS)
         self.link.del_connector(addr)
 
 #############################################################################
@@ -184,11 +301,114 @@ class TestLink(utils.TestCase):
 
     ########################################################
 
+    @timed(LOOP_RUNTIME_ASSERT)
+    def test_tune_socket(self):
+        """
+        Both accepted and connected sockets are tuned.
+        """
+        for link in (self.link_server, self.link_client):
+            link.tune_socket = mock.Mock(wraps=link.tune_socket)
+
+        def run(link):
+            def on_connect(conn_id):
+                link.stop()
+
+            link.on_connect = on_connect
+            link.loop(runtime=LOOP_RUNTIME)
+
+        self.run_srv_cli(run, run)
+        for link in (self.link_server, self.link_client):
+            self.assertEqual(link.tune_socket.call_count, 1)
+            sock = link.tune_socket.call_args[0][0]
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY))
+            self.assertGreaterEqual(sock.getsockopt(socket.SOL_SOCKET,
+                                    socket.SO_RCVBUF), link.recv_block_size)
+
+    ########################################################
+
+    def test_tune_socket_buffers(self):
+        link = self.link_server
+        sock = mock.Mock()
+        # buffers are left to the kernel if they are large enough
+        sock.getsockopt.return_value = link.recv_block_size
+        link.tune_socket(sock)
+        sock.setsockopt.assert_called_once_with(socket.IPPROTO_TCP,
+                                                socket.TCP_NODELAY, 1)
+        sock.setsockopt.reset_mock()
+        sock.getsockopt.return_value = link.recv_block_size - 1
+        link.tune_socket(sock)
+        sock.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                        link.recv_block_size)
+        sock.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                        link.recv_block_size)
+
+    ########################################################
+
     def test_recv_on_closed_socket(self):
         sock = snakemq.link.LinkSocket()
         # this must not raise an exception
         self.link_server.handle_recv(sock)
 
+    ########################################################
+
+    def test_recv_block_size_grow(self):
+        link = self.link_server
+        link.recv_block_size = snakemq.link.RECV_BLOCK_SIZE * 2
+        sock = mock.Mock()
+        sock.conn_id = 1
+        sock.is_ssl = False
+        sock.recv_into.side_effect = [link.recv_block_size, 1]
+        link.on_recv = mock.Mock()
+        link.handle_recv(sock)
+        sock.recv_into.assert_called_with(mock.ANY, link.recv_block_size)
+        fragment = link.on_recv.call_args_list[0][0][1]
+        self.assertEqual(type(fragment), bytes)
+        self.assertEqual(len(fragment), link.recv_block_size)
+
+    ########################################################
+
+    def test_recv_drain(self):
+        link = self.link_server
+        sock = mock.Mock()
+        sock.conn_id = 1
+        sock.is_ssl = False
+        sock.poll_mask = select.EPOLLIN
+        # full blocks only, the drain must stop anyway
+        sock.recv_into.side_effect = lambda buf, length: length
+        link.on_recv = mock.Mock()
+        with mock.patch.object(link, "poller") as poller:
+            link.handle_recv(sock)
+            self.assertEqual(sock.recv_into.call_count,
+                              snakemq.link.MAX_RECV_DRAIN)
+            self.assertEqual(link.on_recv.call_count,
+                              snakemq.link.MAX_RECV_DRAIN)
+            # the rest is read in the next round, not by the poll
+            self.assertEqual(list(link._undrained), [sock])
+            self.assertFalse(poller.modify.called)
+
+            # short read means that the socket is drained
+            link._undrained.clear()
+            sock.recv_into.reset_mock()
+            sock.recv_into.side_effect = lambda buf, length: length - 1
+            link.handle_recv(sock)
+            self.assertEqual(sock.recv_into.call_count, 1)
+            self.assertEqual(len(link._undrained), 0)
+
+    ########################################################
+
+    def test_accept_drain(self):
+        link = self.link_server
+        listen_sock = mock.Mock()
+        listen_sock.accept.side_effect = [
+                                  ("sock1", ("localhost", 1)),
+                                  ("sock2", ("localhost", 2)),
+                                  socket.error(errno.EWOULDBLOCK, "again")]
+        with mock.patch.object(link, "handle_new_conn") as handle_new_conn:
+            link.handle_accept(listen_sock)
+        self.assertEqual(handle_new_conn.call_count, 2)
+        self.assertEqual(len(link._undrained), 0)
+
 #############################################################################
 #############################################################################
 
@@ -203,33 +423,167 @@ class TestLinkSSL(TestLink):
         link_client.add_connector(("localhost", TEST_PORT), ssl_config=cfg)
         return link_server, link_client
 
+#############################################################################
+#############################################################################
+
+class TestSSLHandshake(utils.TestCase):
+    """
+    Handshake bookkeeping with mocked sockets, no certificates needed.
+    """
+
+    def setUp(self):
+        self.link = snakemq.link.Link()
+        self.link.poller = mock.Mock()
+
     ########################################################
 
-    def test_ssl_handshake_none_sslobj(self):
-        link = snakemq.link.Link()
+    def tearDown(self):
+        self.link.cleanup()
+
+    ########################################################
+
+    def create_sock(self):
         sock = mock.Mock()
+        sock.sock._sslobj = mock.Mock()  # anything but None
+        sock.handshake_future = None
+        sock.in_ssl_handshake = False
+        sock.poll_mask = 0
+        return sock
+
+    ########################################################
+
+    def test_ssl_handshake_none_sslobj(self):
+        sock = self.create_sock()
         sock.sock._sslobj = None
-        link._in_ssl_handshake.add(sock)
-        link.poller = mock.Mock()
-        self.assertEqual(link.ssl_handshake(sock), snakemq.link.SSL_HANDSHAKE_FAILED)
-        self.assertNotIn(sock, link._in_ssl_handshake)
+        self.assertEqual(self.link.begin_ssl_handshake(sock),
+                          snakemq.link.SSL_HANDSHAKE_FAILED)
+        self.assertFalse(sock.in_ssl_handshake)
 
     ########################################################
 
     def test_failed_handshake_cleanup(self):
-        link = snakemq.link.Link()
-        sock = mock.Mock()
-        sock.sock._sslobj = mock.Mock()  # anything but None
+        link = self.link
+        link.use_thread_pool = False  # make the step synchronous
+        sock = self.create_sock()
         sock.sock.do_handshake.side_effect = socket.error()
-        link._in_ssl_handshake.add(sock)
         def handle_close(sock):
             # during handle_close() the socket must be still have
             # the "handshake flag"
-            self.assertIn(sock, link._in_ssl_handshake)
+            self.assertTrue(sock.in_ssl_handshake)
         link.handle_close = mock.Mock(wraps=handle_close)
-        link.poller = mock.Mock()
-        self.assertEqual(link.ssl_handshake(sock), snakemq.link.SSL_HANDSHAKE_FAILED)
-        self.assertNotIn(sock, link._in_ssl_handshake)
+        self.assertEqual(link.begin_ssl_handshake(sock),
+                          snakemq.link.SSL_HANDSHAKE_FAILED)
+        self.assertFalse(sock.in_ssl_handshake)
+        self.assertEqual(link.handle_close.call_count, 1)
+
+    ########################################################
+
+    def test_handshake_poll_mask(self):
+        link = self.link
+        link.use_thread_pool = False  # make the step synchronous
+        sock = self.create_sock()
+        ssl = snakemq.link.ssl
+        sock.sock.do_handshake.side_effect = \
+                        ssl.SSLError(ssl.SSL_ERROR_WANT_READ, "want read")
+        self.assertEqual(link.begin_ssl_handshake(sock),
+                          snakemq.link.SSL_HANDSHAKE_IN_PROGRESS)
+        self.assertEqual(link.ssl_handshake(sock),
+                          snakemq.link.SSL_HANDSHAKE_IN_PROGRESS)
+        # the mask did not change in the second step
+        link.poller.modify.assert_called_once_with(sock.fd,
+                      select.EPOLLIN | snakemq.link.POLL_EDGE)
+        link.end_ssl_handshake(sock)
+
+    ########################################################
+
+    def test_handshake_done_reads(self):
+        link = self.link
+        link.use_thread_pool = False  # make the step synchronous
+        sock = self.create_sock()
+        sock.poll_mask = select.EPOLLIN
+        sock.sock.do_handshake.side_effect = None
+        self.assertEqual(link.begin_ssl_handshake(sock),
+                          snakemq.link.SSL_HANDSHAKE_DONE)
+        # the mask did not change so the poll would not report the data
+        # which came with the handshake
+        self.assertFalse(link.poller.modify.called)
+        self.assertEqual(list(link._undrained), [sock])
+        link._undrained.clear()
+
+    ########################################################
+
+    def test_handshake_in_pool_poll_mask(self):
+        link = self.link
+        link.on_connect = mock.Mock()
+        sock = self.create_sock()
+        sock.poll_mask = select.EPOLLIN
+        ssl = snakemq.link.ssl
+
+        def step(err):
+            sock.sock.do_handshake.side_effect = err
+            link.poller.modify.reset_mock()
+            if sock.in_ssl_handshake:
+                res = link.ssl_handshake(sock)
+            else:
+                res = link.begin_ssl_handshake(sock)
+            self.assertEqual(res, snakemq.link.SSL_HANDSHAKE_IN_PROGRESS)
+            # submitting the step does not touch the poller
+            self.assertFalse(link.poller.modify.called)
+            sock.handshake_future.result()
+            while not link._handshakes_done:
+                time.sleep(0.01)  # done callback runs after the result
+            link.deal_handshakes()
+
+        # every step costs exactly one modify, either the socket is
+        # reevaluated with the same mask or the mask changes
+        step(ssl.SSLError(ssl.SSL_ERROR_WANT_READ, "want read"))
+        link.poller.modify.assert_called_once_with(sock.fd,
+                      select.EPOLLIN | snakemq.link.POLL_EDGE)
+        step(ssl.SSLError(ssl.SSL_ERROR_WANT_WRITE, "want write"))
+        link.poller.modify.assert_called_once_with(sock.fd,
+                      select.EPOLLOUT | snakemq.link.POLL_EDGE)
+        step(None)
+        link.poller.modify.assert_called_once_with(sock.fd,
+                      select.EPOLLIN | snakemq.link.POLL_EDGE)
+        self.assertFalse(sock.in_ssl_handshake)
+        link.on_connect.assert_called_once_with(sock.conn_id)
+
+    ########################################################
+
+    def test_handshake_limit(self):
+        link = self.link
+        link.max_handshakes = 0
+        newsock = mock.Mock()
+        newsock.is_ssl = True
+        listen_sock = mock.Mock()
+        listen_sock.accept.side_effect = [(newsock, ("localhost", 1)),
+                                    socket.error(errno.EWOULDBLOCK, "again")]
+        link.on_connect = mock.Mock()
+        link.handle_accept(listen_sock)
+        self.assertEqual(newsock.close.call_count, 1)
+        self.assertEqual(len(link._sock_by_fd), 0)
+        self.assertEqual(len(link._sock_by_conn), 0)
+        self.assertFalse(link.on_connect.called)
+
+    ########################################################
+
+    def test_handshake_in_pool(self):
+        link = self.link
+        sock = self.create_sock()
+        sock.sock.do_handshake.side_effect = socket.error()
+        link.handle_close = mock.Mock()
+        self.assertIsNone(link._pool)  # no pool before the first handshake
+        self.assertEqual(link.begin_ssl_handshake(sock),
+                          snakemq.link.SSL_HANDSHAKE_IN_PROGRESS)
+        # no other step while the first one is running
+        self.assertEqual(link.ssl_handshake(sock),
+                          snakemq.link.SSL_HANDSHAKE_IN_PROGRESS)
+        sock.handshake_future.result()
+        link._pool.shutdown(wait=True)  # done callbacks finished
+        link.deal_handshakes()
+        self.assertEqual(sock.sock.do_handshake.call_count, 1)
+        self.assertFalse(sock.in_ssl_handshake)
+        self.assertEqual(sock.handshake_future, None)
         self.assertEqual(link.handle_close.call_count, 1)
 
 #############################################################################
@@ -250,16 +604,126 @@ class TestLinkSSLFailures(utils.TestCase):
 #############################################################################
 #############################################################################
 
-class TestBell(utils.TestCase):
+class TestLinkSend(utils.TestCase):
+    def setUp(self):
+        self.link = snakemq.link.Link()
+        self.link.poller = mock.Mock()
+        self.link.poller.poll.return_value = []
+        self.link.on_ready_to_send = mock.Mock()
+        self.sock = mock.Mock()
+        self.sock.conn_id = 1
+        self.sock.write_buf = None
+        self.sock.poll_mask = select.EPOLLIN
+        self.link._sock_by_conn[1] = self.sock
+
+    ########################################################
+
+    def tearDown(self):
+        # the sockets were never registered, cleanup() must not close them
+        self.link._sock_by_conn.clear()
+        self.link.cleanup()
+
+    ########################################################
+
+    def test_full_send(self):
+        self.sock.last_send_size = 3
+        self.link.send(1, b"abc")
+        self.assertFalse(self.link.poller.modify.called)
+        self.link.poll(1.0)
+        # ready to send is already due, do not block
+        self.link.poller.poll.assert_called_once_with(0,
+                                      snakemq.link.MAX_POLL_EVENTS)
+        self.link.on_ready_to_send.assert_called_once_with(1, 3)
+
+    ########################################################
+
+    def test_short_send(self):
+        self.sock.last_send_size = 2
+        self.sock.write_buf = b"c"
+        self.link.send(1, b"abc")
+        self.link.poller.modify.assert_called_once_with(self.sock.fd,
+                        select.EPOLLIN | select.EPOLLOUT |
+                        snakemq.link.POLL_EDGE)
+        self.link.poll(0)
+        self.assertFalse(self.link.on_ready_to_send.called)
+
+    ########################################################
+
+    def test_send_limit(self):
+        self.link.max_write_buf = 2
+        self.link.send(1, b"abc")
+        self.assertEqual(bytes(self.sock.send.call_args[0][0]), b"ab")
+
+    ########################################################
+
+    def test_send_rest(self):
+        sock_a, sock_b = socket.socketpair()
+        sock_a.setblocking(False)
+        sock = snakemq.link.LinkSocket(sock_a)
+        sock.conn_id = 1
+        self.link._sock_by_conn[1] = sock
+        data = b"x" * (4 * 1024 * 1024)
+        try:
+            self.link.send(1, data)
+            self.assertIsNotNone(sock.write_buf)
+            self.assertLess(sock.last_send_size, len(data))
+            while sock.write_buf is not None:
+                sock_b.recv(len(data))
+                self.link.handle_ready_to_send(sock)
+            self.link.on_ready_to_send.assert_called_once_with(1, len(data))
+        finally:
+            sock_a.close()
+            sock_b.close()
+
+#############################################################################
+#############################################################################
+
+class TestRecvBufPool(utils.TestCase):
+    def test_reuse(self):
+        buf = snakemq.link._acquire_recv_buf(snakemq.link.RECV_BLOCK_SIZE)
+        snakemq.link._release_recv_buf(buf)
+        self.assertIs(snakemq.link._acquire_recv_buf(1), buf)
+
+    ########################################################
+
+    def test_oversized_dropped(self):
+        buf = snakemq.link._acquire_recv_buf(snakemq.link.RECV_BLOCK_SIZE + 1)
+        self.assertEqual(len(buf), snakemq.link.RECV_BLOCK_SIZE + 1)
+        snakemq.link._release_recv_buf(buf)
+        self.assertNotIn(buf, snakemq.link._RECV_BUF_POOL)
+
+#############################################################################
+#############################################################################
+
+class TestPosixBell(utils.TestCase):
+    __test__ = os.name != "nt"
+
     def test_bell_pipe(self):
-        link = snakemq.link.Link()
+        bell = snakemq.pollbell.PosixBell()
         buf = b"abc"
-        link._poll_bell.write(buf)
-        link._poll_bell.wait(0.2)
-        self.assertEqual(link._poll_bell.read(len(buf)), buf)
+        bell.write(buf)
+        bell.wait(0.2)
+        self.assertEqual(bell.read(len(buf)), buf)
+        bell.close()
 
-    ########################################################
+#############################################################################
+#############################################################################
+
+class TestEventfdBell(utils.TestCase):
+    __test__ = hasattr(os, "eventfd")
 
+    def test_bell_eventfd(self):
+        bell = snakemq.pollbell.EventfdBell()
+        for _ in range(3):
+            bell.ring()
+        bell.flush()  # all rings at once
+        self.assertRaises(OSError, bell.flush)
+        bell.close()
+
+#############################################################################
+#############################################################################
+
+class TestBell(utils.TestCase):
     def test_bell_wakeup(self):
         """
         Bell must fire event only on wake up call. Otherwise it must block the
@@ -276,13 +740,8 @@ class TestBell(utils.TestCase):
         self.assertEqual(len(fds), 1)
         self.assertEqual(fds[0][0], bell_rd)
 
-        # make sure that the pipe is flushed after wakeup
-        try:
-            link._poll_bell.read(1)
-        except OSError as exc:
-            self.assertEqual(exc.errno, errno.EAGAIN)
-        else:
-            self.fail()
+        # make sure that the bell is flushed after wakeup
+        self.assertEqual(len(link.poll(0)), 0)
 
 #############################################################################
 #############################################################################